@@ -11,7 +11,7 @@ from pydantic import BaseModel
 import logging
 
 # Import our existing pipeline
-from src.pipeline import CreativeAnalyticsPipeline
+from src.pipeline import CreativeAnalyticsPipeline, Deadline, DeadlineExceeded, DEADLINE_EXCEEDED
 
 # Setup Logging
 logging.basicConfig(level=logging.INFO)
@@ -54,6 +54,23 @@ if not API_KEY:
     # In production, we might raise an error, but for now we'll just log it 
     # and fail gracefully inside endpoints if needed.
 
+# End-to-end deadlines (seconds) for each endpoint. Every download, upload,
+# poll and generation step inside a request shares its endpoint's deadline.
+MARKET_ANALYSIS_DEADLINE = float(os.environ.get("MARKET_ANALYSIS_DEADLINE", "600"))
+CREATIVE_ANALYSIS_DEADLINE = float(os.environ.get("CREATIVE_ANALYSIS_DEADLINE", "180"))
+
+# Within a market analysis: cap per competitor creative, and time held back
+# from MARKET_ANALYSIS_DEADLINE for the final synthesis call.
+PER_CREATIVE_DEADLINE = float(os.environ.get("PER_CREATIVE_DEADLINE", "120"))
+SYNTHESIS_RESERVE = float(os.environ.get("SYNTHESIS_RESERVE", "60"))
+
+# Optional: send a duplicate generation request once a call runs past this
+# percentile of recent latencies (e.g. "95"). Disabled when unset.
+HEDGE_PERCENTILE = os.environ.get("GENERATION_HEDGE_PERCENTILE")
+HEDGE_PERCENTILE = float(HEDGE_PERCENTILE) if HEDGE_PERCENTILE else None
+if HEDGE_PERCENTILE is not None and not 0 < HEDGE_PERCENTILE < 100:
+    raise ValueError(f"GENERATION_HEDGE_PERCENTILE must be between 0 and 100, got {HEDGE_PERCENTILE}")
+
 # Mount static files for the frontend
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -105,15 +122,22 @@ async def analyze_market(request: Request):
     if not API_KEY:
         return JSONResponse(content={"status": "error", "message": "Server API Key not configured."}, status_code=500)
     
+    pipeline = None
     try:
         STATE['is_processing'] = True
         logger.info("Starting Market Analysis...")
+        deadline = Deadline(MARKET_ANALYSIS_DEADLINE)
         
         # Initialize Pipeline
-        pipeline = CreativeAnalyticsPipeline(api_key=API_KEY)
+        pipeline = CreativeAnalyticsPipeline(
+            api_key=API_KEY,
+            hedge_percentile=HEDGE_PERCENTILE,
+            creative_deadline=PER_CREATIVE_DEADLINE,
+            synthesis_reserve=SYNTHESIS_RESERVE
+        )
         
         # Run Phase 1 & 2
-        winning_dna = pipeline.get_winning_dna(STATE['market_data_path'])
+        winning_dna = pipeline.get_winning_dna(STATE['market_data_path'], deadline=deadline)
         
         if not winning_dna:
             raise Exception("Winning DNA synthesis failed. Please check your CSV file format.")
@@ -130,11 +154,24 @@ async def analyze_market(request: Request):
         
         return JSONResponse(content={
             "status": "success",
-            "winning_dna": winning_dna
+            "winning_dna": winning_dna,
+            "creatives": pipeline.creative_statuses
         })
+    except DeadlineExceeded as e:
+        STATE['is_processing'] = False
+        logger.error(f"Market analysis timed out: {e}")
+        return JSONResponse(content={
+            "status": "error",
+            "message": str(e),
+            "creatives": pipeline.creative_statuses if pipeline else []
+        }, status_code=504)
     except Exception as e:
         STATE['is_processing'] = False
-        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
+        return JSONResponse(content={
+            "status": "error",
+            "message": str(e),
+            "creatives": pipeline.creative_statuses if pipeline else []
+        }, status_code=500)
 
 class AnalyzeRequest(BaseModel):
     video_url: str = None  # Removed api_key
@@ -155,6 +192,8 @@ async def analyze_creative_file(
         return JSONResponse(content={"status": "error", "message": "Server API Key not configured."}, status_code=500)
     
     try:
+        deadline = Deadline(CREATIVE_ANALYSIS_DEADLINE)
+
         # Save uploaded video asynchronously
         file_location = f"temp_creative_{file.filename}"
         
@@ -163,7 +202,7 @@ async def analyze_creative_file(
             while content := await file.read(1024 * 1024):  # Read in 1MB chunks
                 await out_file.write(content)
         
-        pipeline = CreativeAnalyticsPipeline(api_key=API_KEY)
+        pipeline = CreativeAnalyticsPipeline(api_key=API_KEY, hedge_percentile=HEDGE_PERCENTILE)
         
         # 1. Build Prompt (Fast, CPU bound, can stay or be threaded)
         system_prompt = pipeline.build_dynamic_prompt(STATE['winning_dna'])
@@ -173,8 +212,13 @@ async def analyze_creative_file(
         logger.info(f"Analyzing creative: {file_location}")
         
         # Offload blocking call to threadpool
-        my_ad_analysis = await run_in_threadpool(pipeline._analyze_video, file_location)
+        my_ad_analysis = await run_in_threadpool(pipeline._analyze_video, file_location, deadline=deadline)
         
+        if my_ad_analysis.get("status") == DEADLINE_EXCEEDED:
+            if os.path.exists(file_location):
+                os.remove(file_location)
+            return JSONResponse(content={"status": "error", "message": my_ad_analysis['error']}, status_code=504)
+
         # 3. Generate Report (Blocking I/O - Run in Threadpool)
         context = f"""
         MARKET BENCHMARK (WINNING DNA):
@@ -184,7 +228,7 @@ async def analyze_creative_file(
         {my_ad_analysis}
         """
         
-        final_report = await run_in_threadpool(pipeline._generate_content, system_prompt, context)
+        final_report = await run_in_threadpool(pipeline._generate_content, system_prompt, context, deadline=deadline)
         
         # Cleanup
         if os.path.exists(file_location):
@@ -196,6 +240,11 @@ async def analyze_creative_file(
             "creative_analysis": my_ad_analysis
         })
 
+    except DeadlineExceeded as e:
+        logger.error(f"analyze_creative_file timed out: {str(e)}")
+        if os.path.exists(file_location):
+            os.remove(file_location)
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=504)
     except Exception as e:
         logger.error(f"Error in analyze_creative_file: {str(e)}")
         return JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
@@ -211,17 +260,20 @@ async def analyze_creative_url(request: AnalyzeRequest):
         return JSONResponse(content={"status": "error", "message": "Server API Key not configured."}, status_code=500)
 
     try:
-        pipeline = CreativeAnalyticsPipeline(api_key=API_KEY)
+        deadline = Deadline(CREATIVE_ANALYSIS_DEADLINE)
+        pipeline = CreativeAnalyticsPipeline(api_key=API_KEY, hedge_percentile=HEDGE_PERCENTILE)
         
         # 1. Build Prompt
         system_prompt = pipeline.build_dynamic_prompt(STATE['winning_dna'])
         
         # 2. Analyze Video (Downloads URL -> Temp -> Gemini)
         logger.info(f"Analyzing creative URL: {request.video_url}")
-        my_ad_analysis = pipeline._analyze_video(request.video_url)
+        my_ad_analysis = pipeline._analyze_video(request.video_url, deadline=deadline)
         
+        if my_ad_analysis.get("status") == DEADLINE_EXCEEDED:
+            return JSONResponse(content={"status": "error", "message": my_ad_analysis['error']}, status_code=504)
         if "error" in my_ad_analysis:
-             return JSONResponse(content={"status": "error", "message": my_ad_analysis['error']}, status_code=400)
+            return JSONResponse(content={"status": "error", "message": my_ad_analysis['error']}, status_code=400)
 
         # 3. Generate Report
         context = f"""
@@ -232,7 +284,7 @@ async def analyze_creative_url(request: AnalyzeRequest):
         {my_ad_analysis}
         """
         
-        final_report = pipeline._generate_content(system_prompt, context)
+        final_report = pipeline._generate_content(system_prompt, context, deadline=deadline)
         
         return JSONResponse(content={
             "status": "success",
@@ -240,5 +292,7 @@ async def analyze_creative_url(request: AnalyzeRequest):
             "creative_analysis": my_ad_analysis
         })
 
+    except DeadlineExceeded as e:
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=504)
     except Exception as e:
         return JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
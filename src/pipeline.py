@@ -5,81 +5,349 @@ import csv
 import random
 import requests
 import tempfile
+import math
+import socket
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
 import google.generativeai as genai
 from .prompts import BENCHMARK_SYNTHESIZER_PROMPT, ANALYZER_PROMPT_TEMPLATE, VIDEO_ANALYSIS_PROMPT
 
+# ==============================================================================
+# SECTION 1b: DEADLINES
+# ==============================================================================
+
+# Status recorded against a creative whose analysis ran out of time
+DEADLINE_EXCEEDED = "deadline_exceeded"
+
+# Upper bound for any single download read, even with plenty of deadline left
+DOWNLOAD_READ_TIMEOUT_SECONDS = 60
+# Interval between Gemini file-state polls while a video is PROCESSING
+POLL_INTERVAL_SECONDS = 2
+# Time held back from the market deadline for the final synthesis call
+SYNTHESIS_RESERVE_SECONDS = 60
+# Cap on a single competitor creative so one stuck video can't eat the whole run
+CREATIVE_DEADLINE_SECONDS = 120
+
+# Hedge delay used until we have enough latency samples to pick a percentile
+DEFAULT_HEDGE_DELAY_SECONDS = 30
+HEDGE_MIN_SAMPLES = 10
+HEDGE_HISTORY_SIZE = 100
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a pipeline step runs past its end-to-end deadline."""
+
+
+class Deadline:
+    """
+    An absolute point in time by which a unit of work must finish.
+    A Deadline created with seconds=None never expires.
+    """
+
+    def __init__(self, seconds=None):
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    @classmethod
+    def _at(cls, expires_at):
+        deadline = cls()
+        deadline.expires_at = expires_at
+        return deadline
+
+    def remaining(self):
+        """Seconds left (never negative), or None if unbounded."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def timeout(self, cap=None):
+        """Remaining time clamped to `cap`, for use as a per-call timeout."""
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        if cap is None:
+            return remaining
+        return min(remaining, cap)
+
+    def child(self, seconds):
+        """A deadline `seconds` from now, never later than this one."""
+        expires_at = time.monotonic() + seconds
+        if self.expires_at is not None:
+            expires_at = min(expires_at, self.expires_at)
+        return Deadline._at(expires_at)
+
+    def reserve(self, seconds):
+        """A deadline that ends `seconds` before this one (no earlier than now)."""
+        if self.expires_at is None:
+            return self
+        return Deadline._at(max(time.monotonic(), self.expires_at - seconds))
+
+    def check(self, step):
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline exceeded during {step}")
+
+
+def _submit_daemon(fn, *args, **kwargs):
+    """
+    Runs fn on a daemon thread and returns a Future for its result.
+    Unlike ThreadPoolExecutor workers, daemon threads are not joined at
+    interpreter exit, so an abandoned call can't block server shutdown.
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def _call_with_deadline(deadline, step, fn, *args, **kwargs):
+    """
+    Runs a blocking call and stops waiting for it once the deadline passes.
+    Python threads can't be killed, so the worker is abandoned, not stopped:
+    it lingers until fn returns. Callers should give fn its own timeout where
+    the client supports one. genai.upload_file and genai.get_file don't, so a
+    hung upload or poll keeps its (daemon) thread until the process exits.
+    """
+    if deadline.remaining() is None:
+        return fn(*args, **kwargs)
+
+    deadline.check(step)
+    future = _submit_daemon(fn, *args, **kwargs)
+    try:
+        return future.result(timeout=deadline.remaining())
+    except FutureTimeoutError:
+        future.cancel()
+        raise DeadlineExceeded(f"Deadline exceeded during {step}")
+
+
+def _abort_response(response):
+    """
+    Unblocks a streaming read of `response` that is running on another thread.
+    response.close() can't do this (it waits on the reader's buffer lock), so
+    shut down the underlying socket; the blocked read then fails at once.
+    """
+    fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
 # ==============================================================================
 # SECTION 2: THE PIPELINE LOGIC (The "Body")
 # ==============================================================================
 
 class CreativeAnalyticsPipeline:
-    def __init__(self, api_key):
+    # Recent successful generation latencies, shared across instances since the
+    # server builds a fresh pipeline per request. Keyed by "video" / "text".
+    _latencies = {"video": deque(maxlen=HEDGE_HISTORY_SIZE), "text": deque(maxlen=HEDGE_HISTORY_SIZE)}
+    _latencies_lock = threading.Lock()
+
+    def __init__(self, api_key, hedge_percentile=None,
+                 creative_deadline=CREATIVE_DEADLINE_SECONDS, synthesis_reserve=SYNTHESIS_RESERVE_SECONDS):
         self.api_key = api_key
         if not api_key:
             raise ValueError("API Key is required for CreativeAnalyticsPipeline")
+        if hedge_percentile is not None and not 0 < hedge_percentile < 100:
+            raise ValueError("hedge_percentile must be between 0 and 100")
+
+        # When set, slow generations get a duplicate request once they run
+        # past this percentile of recently observed latencies.
+        self.hedge_percentile = hedge_percentile
+        # Market analysis budget: cap per competitor creative, and time held
+        # back from the overall deadline for the final synthesis call.
+        self.creative_deadline = creative_deadline
+        self.synthesis_reserve = synthesis_reserve
+        # Per-creative outcome of the last get_winning_dna run
+        self.creative_statuses = []
         
         # Configure the Gemini API
         genai.configure(api_key=self.api_key)
         self.model = genai.GenerativeModel('gemini-3-pro-preview') 
 
-    def _generate_content(self, system_prompt, user_input, video_file=None):
+    def _record_latency(self, kind, seconds):
+        with self._latencies_lock:
+            self._latencies[kind].append(seconds)
+
+    def _hedge_delay(self, kind):
+        """
+        Returns how long to wait before sending a hedged duplicate request:
+        the configured percentile of recent latencies for this kind of call.
+        """
+        with self._latencies_lock:
+            samples = sorted(self._latencies[kind])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY_SECONDS
+        index = max(0, math.ceil(self.hedge_percentile / 100 * len(samples)) - 1)
+        return samples[index]
+
+    def _timed_generate(self, contents, kind, deadline):
+        """
+        Single generate_content call, bounded by the deadline on the client side.
+        """
+        start = time.monotonic()
+        request_timeout = deadline.remaining()
+        if request_timeout is None:
+            response = self.model.generate_content(contents)
+        else:
+            response = self.model.generate_content(contents, request_options={"timeout": request_timeout})
+        text = response.text
+        self._record_latency(kind, time.monotonic() - start)
+        return text
+
+    def _hedged_generate(self, contents, kind, deadline):
+        """
+        Sends the request, and if it hasn't answered within the hedge delay,
+        sends a duplicate. The first successful response wins.
+        """
+        pending = {_submit_daemon(self._timed_generate, contents, kind, deadline)}
+        done, _ = wait(pending, timeout=deadline.timeout(self._hedge_delay(kind)))
+        if not done and not deadline.expired():
+            print("   [Hedge] Generation is slow, sending a duplicate request...")
+            pending.add(_submit_daemon(self._timed_generate, contents, kind, deadline))
+
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded("Deadline exceeded during generation")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _generate_content(self, system_prompt, user_input, video_file=None, deadline=None):
         """
         Generates content using the Gemini model.
+        Raises DeadlineExceeded if no response arrives before the deadline.
         """
         print(f"\n[System] Sending prompt to Gemini... (Input length: {len(str(user_input))} chars)")
+        deadline = deadline or Deadline()
         
         try:
             if video_file:
                 # Gemini 1.5 Pro takes [system_prompt, video_file, user_prompt] or similar structure
                 # We'll prepend the system prompt to the user input for simplicity or use system_instruction if supported
                 # For this implementation, we just pass list of contents
-                response = self.model.generate_content([system_prompt, video_file, user_input])
+                contents, kind = [system_prompt, video_file, user_input], "video"
             else:
-                response = self.model.generate_content([system_prompt, user_input])
-            return response.text
+                contents, kind = [system_prompt, user_input], "text"
+
+            if self.hedge_percentile is not None:
+                return self._hedged_generate(contents, kind, deadline)
+            return _call_with_deadline(deadline, "generation", self._timed_generate, contents, kind, deadline)
+        except DeadlineExceeded as e:
+            print(f"Gemini API call cancelled: {e}")
+            raise
         except Exception as e:
+            # The SDK's own request timeout races our deadline wait; if the
+            # deadline has passed, report it as such rather than an API error.
+            if deadline.expired():
+                print(f"Gemini API call cancelled: {e}")
+                raise DeadlineExceeded("Deadline exceeded during generation") from e
             print(f"Error calling Gemini API: {e}")
             raise Exception(f"Gemini API Error: {str(e)}")
 
-    def _download_video(self, url):
+    def _fetch_to_tempfile(self, url, deadline, handle):
         """
-        Downloads a video from a URL to a temporary file.
-        Returns the path to the temporary file.
+        Streams a URL into a temporary file and returns its path.
+        Runs on a worker thread under _download_video, which may abort the
+        response stored in `handle` once the deadline passes. Removes its own
+        temp file on any failure, including finishing after the deadline.
         """
-        print(f"   [Download] Downloading video from {url}...")
+        tfile = None
+        response = None
         try:
-            # excessive timeout to handle larger files if needed, but keeping it reasonable for now
-            response = requests.get(url, stream=True, timeout=60)
+            read_timeout = deadline.timeout(DOWNLOAD_READ_TIMEOUT_SECONDS)
+            response = requests.get(url, stream=True, timeout=read_timeout)
+            handle["response"] = response
+            # Checked after publishing the response, so a deadline that passed
+            # before _download_video could see it is still caught here.
+            deadline.check("download")
             response.raise_for_status()
             
             # Create a temp file. We used named temp file so we can pass the path to Gemini.
             # We don't delete on close so we can upload it, then we manually delete.
             tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
             
+            # A slow sender can keep a single read blocked well past the
+            # deadline; _download_video unblocks it by aborting the response.
             for chunk in response.iter_content(chunk_size=8192):
+                deadline.check("download")
                 if chunk:
                     tfile.write(chunk)
             
             tfile.close()
-            print(f"   [Download] Saved to temporary file: {tfile.name}")
+            deadline.check("download")
             return tfile.name
+        except Exception:
+            if tfile is not None:
+                tfile.close()
+                os.remove(tfile.name)
+            raise
+        finally:
+            if response is not None:
+                response.close()
+
+    def _download_video(self, url, deadline=None):
+        """
+        Downloads a video from a URL to a temporary file.
+        Returns the path to the temporary file.
+        Raises DeadlineExceeded if the download doesn't finish in time.
+        """
+        print(f"   [Download] Downloading video from {url}...")
+        deadline = deadline or Deadline()
+        handle = {}
+        try:
+            path = _call_with_deadline(deadline, "download", self._fetch_to_tempfile, url, deadline, handle)
+            print(f"   [Download] Saved to temporary file: {path}")
+            return path
+        except DeadlineExceeded as e:
+            print(f"   [Error] Download cancelled: {e}")
+            if "response" in handle:
+                _abort_response(handle["response"])
+            raise
         except Exception as e:
+            # A read timeout mid-stream surfaces from requests as a
+            # ConnectionError, so map any failure past the deadline.
+            if deadline.expired():
+                print(f"   [Error] Download cancelled: {e}")
+                raise DeadlineExceeded("Deadline exceeded during download") from e
             print(f"   [Error] Failed to download video: {e}")
             return None
 
-    def _analyze_video(self, video_path_or_url):
+    def _analyze_video(self, video_path_or_url, deadline=None):
         """
         Analyzes a video using Gemini 1.5 Pro.
         Handles both local paths and URLs (by downloading them first).
+        If the deadline passes, returns an error dict with status DEADLINE_EXCEEDED.
         """
         print(f"  > Analyzing video: {video_path_or_url}")
+        deadline = deadline or Deadline()
         
         local_path = video_path_or_url
         is_temp_file = False
 
         # Check if it's a URL
         if video_path_or_url.startswith("http"):
-            downloaded_path = self._download_video(video_path_or_url)
+            try:
+                downloaded_path = self._download_video(video_path_or_url, deadline=deadline)
+            except DeadlineExceeded as e:
+                return {"error": str(e), "status": DEADLINE_EXCEEDED}
             if not downloaded_path:
                 return {"error": "Failed to download video from URL"}
             local_path = downloaded_path
@@ -90,13 +358,14 @@ class CreativeAnalyticsPipeline:
         if os.path.isfile(local_path):
             print(f"   [Upload] Uploading {local_path} to Gemini...")
             try:
-                video_file = genai.upload_file(path=local_path)
+                video_file = _call_with_deadline(deadline, "upload", genai.upload_file, path=local_path)
                 
                 # Wait for processing
                 while video_file.state.name == "PROCESSING":
+                    deadline.check("video processing")
                     print(".", end="", flush=True)
-                    time.sleep(2)
-                    video_file = genai.get_file(video_file.name)
+                    time.sleep(deadline.timeout(POLL_INTERVAL_SECONDS))
+                    video_file = _call_with_deadline(deadline, "video processing", genai.get_file, video_file.name)
                 
                 if video_file.state.name == "FAILED":
                     print("   [Error] Video processing failed.")
@@ -107,7 +376,8 @@ class CreativeAnalyticsPipeline:
                     response_json = self._generate_content(
                         system_prompt=VIDEO_ANALYSIS_PROMPT,
                         user_input="Analyze this video.",
-                        video_file=video_file
+                        video_file=video_file,
+                        deadline=deadline
                     )
                     
                     try:
@@ -116,6 +386,9 @@ class CreativeAnalyticsPipeline:
                         result = json.loads(cleaned_json)
                     except json.JSONDecodeError:
                         result = {"error": "Failed to parse video analysis"}
+            except DeadlineExceeded as e:
+                print(f"\n   [Error] {e}")
+                result = {"error": str(e), "status": DEADLINE_EXCEEDED}
             except Exception as e:
                  print(f"   [Error] processing video: {e}")
                  result = {"error": str(e)}
@@ -149,13 +422,25 @@ class CreativeAnalyticsPipeline:
         except ValueError:
             return 0.0
 
-    def get_winning_dna(self, csv_path):
+    def get_winning_dna(self, csv_path, deadline=None):
         """
         Step 1: Ingest CSV competitor data, analyze top 20 videos, and synthesize 'Winning DNA'.
+        Creatives that run out of time are passed on as errors so synthesis can still
+        work from the partial set; their outcome is recorded in self.creative_statuses.
+        If no creative succeeded, raises instead of synthesizing (DeadlineExceeded
+        when any of them timed out).
         """
         print(f"\n--- Phase 1: Processing Market Data from {csv_path} ---")
+        deadline = deadline or Deadline()
         
         analyzed_data = []
+        self.creative_statuses = []
+
+        # Hold back time for synthesis (at most half the budget, so short
+        # deadlines still leave room to analyze some creatives).
+        remaining = deadline.remaining()
+        reserve = self.synthesis_reserve if remaining is None else min(self.synthesis_reserve, remaining / 2)
+        analysis_deadline = deadline.reserve(reserve)
 
         try:
             with open(csv_path, 'r', encoding='utf-8') as f:
@@ -180,7 +465,19 @@ class CreativeAnalyticsPipeline:
                     
                     # Simulate video analysis
                     # We check if we have a local download of it, otherwise we treat it as URL
-                    video_insight = self._analyze_video(url)
+                    if analysis_deadline.expired():
+                        print("   [Skip] Market analysis deadline reached.")
+                        video_insight = {"error": "Deadline exceeded before analysis started", "status": DEADLINE_EXCEEDED}
+                    else:
+                        video_insight = self._analyze_video(url, deadline=analysis_deadline.child(self.creative_deadline))
+
+                    self.creative_statuses.append({
+                        "rank": idx + 1,
+                        "app": app_name,
+                        "url": url,
+                        "status": video_insight.get("status", "error" if "error" in video_insight else "success"),
+                        "error": video_insight.get("error")
+                    })
                     
                     # Structure the data for the Synthesizer
                     analyzed_data.append(f"""
@@ -199,10 +496,18 @@ class CreativeAnalyticsPipeline:
         if not analyzed_data:
              raise Exception("No valid rows found in CSV. Check column headers (Advertiser App, Impression Share).")
 
+        # Synthesizing from error dicts alone would invent a benchmark
+        statuses = [creative["status"] for creative in self.creative_statuses]
+        if "success" not in statuses:
+            if DEADLINE_EXCEEDED in statuses:
+                raise DeadlineExceeded("Deadline exceeded before any creative could be analyzed")
+            raise Exception("None of the top creatives could be analyzed. See per-creative errors.")
+
         print("\n--- Phase 1b: Synthesizing 'Winning DNA' from Aggregate Analysis ---")
         response = self._generate_content(
             system_prompt=BENCHMARK_SYNTHESIZER_PROMPT,
-            user_input=full_market_context
+            user_input=full_market_context,
+            deadline=deadline
         )
         try:
             # Clean possible markdown code fences
@@ -232,12 +537,14 @@ class CreativeAnalyticsPipeline:
         )
         return final_prompt
 
-    def analyze_creative(self, creative_file_path, raw_competitor_data):
+    def analyze_creative(self, creative_file_path, raw_competitor_data, deadline=None):
         """
         Main Orchestrator Function.
         """
+        deadline = deadline or Deadline()
+
         # 1. Get the Market Truth
-        winning_dna = self.get_winning_dna(raw_competitor_data)
+        winning_dna = self.get_winning_dna(raw_competitor_data, deadline=deadline)
         print(f"Generated Winning DNA: {winning_dna}")
 
         # 2. Build the Context-Aware Prompt
@@ -248,7 +555,7 @@ class CreativeAnalyticsPipeline:
 
         # Analyze the user's video file
         # This will upload it to Gemini if it's a local path
-        my_ad_analysis = self._analyze_video(creative_file_path)
+        my_ad_analysis = self._analyze_video(creative_file_path, deadline=deadline)
         
         context_for_final_analysis = f"""
         MARKET BENCHMARK (WINNING DNA):
@@ -262,7 +569,8 @@ class CreativeAnalyticsPipeline:
         print("   [Report] Generating final strategic analysis...")
         final_report = self._generate_content(
             system_prompt=system_prompt,
-            user_input=context_for_final_analysis
+            user_input=context_for_final_analysis,
+            deadline=deadline
         )
         
         return final_report
@@ -0,0 +1,393 @@
+import os
+import sys
+import time
+import types
+import tempfile
+import threading
+import http.server
+import socketserver
+
+import pytest
+
+# The Gemini SDK is stubbed so these tests never configure a client or hit the network.
+_genai = types.ModuleType("google.generativeai")
+_genai.configure = lambda **kwargs: None
+_genai.GenerativeModel = lambda name: None
+sys.modules.setdefault("google", types.ModuleType("google")).generativeai = _genai
+sys.modules["google.generativeai"] = _genai
+
+from src import pipeline  # noqa: E402
+from src.pipeline import CreativeAnalyticsPipeline, Deadline, DeadlineExceeded  # noqa: E402
+
+
+class StubModel:
+    """Plays back one behaviour per generate_content call: (delay, text or exception)."""
+
+    def __init__(self, *behaviours):
+        self.behaviours = list(behaviours)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def generate_content(self, contents, request_options=None):
+        with self.lock:
+            delay, outcome = self.behaviours[self.calls]
+            self.calls += 1
+        time.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return types.SimpleNamespace(text=outcome)
+
+
+@pytest.fixture(autouse=True)
+def clear_latencies():
+    for samples in CreativeAnalyticsPipeline._latencies.values():
+        samples.clear()
+    yield
+    for samples in CreativeAnalyticsPipeline._latencies.values():
+        samples.clear()
+
+
+def make_pipeline(model, hedge_percentile=None):
+    p = CreativeAnalyticsPipeline("test-key", hedge_percentile=hedge_percentile)
+    p.model = model
+    return p
+
+
+# --- Deadline -----------------------------------------------------------------
+
+def test_unbounded_deadline():
+    deadline = Deadline()
+    assert deadline.remaining() is None
+    assert not deadline.expired()
+    assert deadline.timeout() is None
+    assert deadline.timeout(5) == 5
+    assert deadline.reserve(10) is deadline
+
+
+def test_timeout_is_clamped_to_remaining():
+    deadline = Deadline(1)
+    assert deadline.timeout(60) <= 1
+    assert deadline.timeout(0.5) == 0.5
+
+
+def test_child_never_outlives_parent():
+    parent = Deadline(1)
+    assert parent.child(60).expires_at == parent.expires_at
+    assert parent.child(0.1).expires_at < parent.expires_at
+    assert Deadline().child(1).remaining() <= 1
+
+
+def test_reserve_ends_early_but_not_in_the_past():
+    deadline = Deadline(100)
+    assert deadline.reserve(60).remaining() == pytest.approx(40, abs=1)
+    assert deadline.reserve(500).remaining() == pytest.approx(0, abs=0.1)
+
+
+def test_check_raises_once_expired():
+    deadline = Deadline(0)
+    assert deadline.expired()
+    with pytest.raises(DeadlineExceeded):
+        deadline.check("test")
+
+
+# --- Hedge delay --------------------------------------------------------------
+
+def test_hedge_delay_falls_back_without_enough_samples():
+    p = make_pipeline(StubModel(), hedge_percentile=95)
+    for seconds in range(pipeline.HEDGE_MIN_SAMPLES - 1):
+        p._record_latency("text", seconds)
+    assert p._hedge_delay("text") == pipeline.DEFAULT_HEDGE_DELAY_SECONDS
+
+
+@pytest.mark.parametrize("percentile, expected", [(95, 95), (50, 50), (1, 1), (99.5, 100)])
+def test_hedge_delay_percentile_index(percentile, expected):
+    p = make_pipeline(StubModel(), hedge_percentile=percentile)
+    for seconds in range(100, 0, -1):
+        p._record_latency("text", seconds)
+    assert p._hedge_delay("text") == expected
+
+
+def test_hedge_delay_is_tracked_per_kind():
+    p = make_pipeline(StubModel(), hedge_percentile=50)
+    for _ in range(pipeline.HEDGE_MIN_SAMPLES):
+        p._record_latency("video", 7)
+    assert p._hedge_delay("video") == 7
+    assert p._hedge_delay("text") == pipeline.DEFAULT_HEDGE_DELAY_SECONDS
+
+
+# --- Generation ---------------------------------------------------------------
+
+@pytest.fixture
+def short_hedge_delay(monkeypatch):
+    monkeypatch.setattr(pipeline, "DEFAULT_HEDGE_DELAY_SECONDS", 0.05)
+
+
+def test_hedged_duplicate_wins_over_slow_primary(short_hedge_delay):
+    model = StubModel((1, "slow"), (0, "fast"))
+    p = make_pipeline(model, hedge_percentile=95)
+    assert p._generate_content("system", "input", deadline=Deadline(5)) == "fast"
+    assert model.calls == 2
+
+
+def test_no_hedge_when_primary_is_fast(short_hedge_delay):
+    model = StubModel((0, "fast"))
+    p = make_pipeline(model, hedge_percentile=95)
+    assert p._generate_content("system", "input", deadline=Deadline(5)) == "fast"
+    assert model.calls == 1
+
+
+def test_hedged_first_failure_waits_for_other_request(short_hedge_delay):
+    model = StubModel((0.2, RuntimeError("boom")), (0.3, "ok"))
+    p = make_pipeline(model, hedge_percentile=95)
+    assert p._generate_content("system", "input", deadline=Deadline(5)) == "ok"
+
+
+def test_hedged_all_fail_reports_api_error(short_hedge_delay):
+    model = StubModel((0.1, RuntimeError("boom")), (0, RuntimeError("boom")))
+    p = make_pipeline(model, hedge_percentile=95)
+    with pytest.raises(Exception, match="Gemini API Error: boom"):
+        p._generate_content("system", "input", deadline=Deadline(5))
+
+
+@pytest.mark.parametrize("hedge_percentile", [None, 95])
+def test_generation_past_deadline_raises_deadline_exceeded(short_hedge_delay, hedge_percentile):
+    model = StubModel((5, "late"), (5, "late"))
+    p = make_pipeline(model, hedge_percentile=hedge_percentile)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        p._generate_content("system", "input", deadline=Deadline(0.3))
+    assert time.monotonic() - start < 1
+
+
+class LaggingDeadline(Deadline):
+    """Expires on time but reports extra remaining time, so our wait loses the race to the SDK."""
+
+    def remaining(self):
+        return super().remaining() + 1
+
+
+@pytest.mark.parametrize("hedge_percentile", [None, 95])
+def test_sdk_timeout_at_deadline_raises_deadline_exceeded(short_hedge_delay, hedge_percentile):
+    timeout = RuntimeError("504 Deadline Exceeded")
+    model = StubModel((0.3, timeout), (0.3, timeout))
+    p = make_pipeline(model, hedge_percentile=hedge_percentile)
+    with pytest.raises(DeadlineExceeded):
+        p._generate_content("system", "input", deadline=LaggingDeadline(0.2))
+
+
+# --- Video processing poll ----------------------------------------------------
+
+class StubFile:
+    def __init__(self, state):
+        self.name = "files/test"
+        self.state = types.SimpleNamespace(name=state)
+
+
+@pytest.fixture
+def local_video(tmp_path):
+    path = tmp_path / "creative.mp4"
+    path.write_bytes(b"video")
+    return str(path)
+
+
+@pytest.fixture
+def fast_poll(monkeypatch):
+    monkeypatch.setattr(pipeline, "POLL_INTERVAL_SECONDS", 0.05)
+
+
+def stub_file_api(monkeypatch, *states):
+    """upload_file returns the first state; each get_file returns the next (the last repeats)."""
+    polls = []
+    monkeypatch.setattr(pipeline.genai, "upload_file", lambda path: StubFile(states[0]), raising=False)
+
+    def get_file(name):
+        polls.append(name)
+        return StubFile(states[min(len(polls), len(states) - 1)])
+
+    monkeypatch.setattr(pipeline.genai, "get_file", get_file, raising=False)
+    return polls
+
+
+def test_poll_waits_for_processing_then_generates(monkeypatch, fast_poll, local_video):
+    polls = stub_file_api(monkeypatch, "PROCESSING", "PROCESSING", "ACTIVE")
+    p = make_pipeline(StubModel((0, '```json{"hook": "fail state"}```')))
+    assert p._analyze_video(local_video, deadline=Deadline(5)) == {"hook": "fail state"}
+    assert len(polls) == 2
+
+
+def test_poll_stuck_in_processing_hits_deadline(monkeypatch, fast_poll, local_video):
+    polls = stub_file_api(monkeypatch, "PROCESSING")
+    model = StubModel()
+    p = make_pipeline(model)
+    start = time.monotonic()
+    result = p._analyze_video(local_video, deadline=Deadline(0.3))
+    assert time.monotonic() - start < 1
+    assert result["status"] == pipeline.DEADLINE_EXCEEDED
+    assert polls
+    assert model.calls == 0
+
+
+def test_failed_processing_is_a_plain_error(monkeypatch, fast_poll, local_video):
+    stub_file_api(monkeypatch, "PROCESSING", "FAILED")
+    result = make_pipeline(StubModel())._analyze_video(local_video, deadline=Deadline(5))
+    assert result == {"error": "Video processing failed"}
+
+
+# --- Download -----------------------------------------------------------------
+
+class VideoHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/missing":
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "1000000" if self.path == "/slow" else "20000")
+        self.end_headers()
+        try:
+            if self.path == "/slow":
+                # Trickle far less than a chunk per read timeout, so only the deadline can stop it
+                while True:
+                    self.wfile.write(b"x" * 10)
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            else:
+                self.wfile.write(b"v" * 20000)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def video_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), VideoHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def temp_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    return tmp_path
+
+
+def test_download_saves_video(video_server, temp_dir):
+    path = make_pipeline(StubModel())._download_video(f"{video_server}/video", deadline=Deadline(5))
+    with open(path, "rb") as f:
+        assert f.read() == b"v" * 20000
+    os.remove(path)
+
+
+def test_download_failure_returns_none(video_server, temp_dir):
+    assert make_pipeline(StubModel())._download_video(f"{video_server}/missing", deadline=Deadline(5)) is None
+    assert os.listdir(temp_dir) == []
+
+
+def test_slow_download_is_aborted_and_cleaned_up(video_server, temp_dir):
+    threads_before = threading.active_count()
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        make_pipeline(StubModel())._download_video(f"{video_server}/slow", deadline=Deadline(0.5))
+    assert time.monotonic() - start < 1
+
+    # The abandoned worker must exit and remove its partial file, not linger on the socket
+    for _ in range(20):
+        if not os.listdir(temp_dir) and threading.active_count() <= threads_before:
+            break
+        time.sleep(0.05)
+    assert os.listdir(temp_dir) == []
+    assert threading.active_count() <= threads_before
+
+
+# --- Market analysis ----------------------------------------------------------
+
+@pytest.fixture
+def market_csv(tmp_path):
+    path = tmp_path / "market.csv"
+    path.write_text(
+        "Advertiser App,Impression Share,Creative URL,Duration\n"
+        "App C,10%,http://c,15\n"
+        "App A,30%,http://a,15\n"
+        "App B,20%,http://b,15\n"
+    )
+    return str(path)
+
+
+def stub_market(monkeypatch, p, analyze):
+    """Replaces video analysis with `analyze(url, deadline)` and records synthesis calls."""
+    synthesized = []
+    monkeypatch.setattr(p, "_analyze_video", analyze)
+
+    def generate(system_prompt, user_input, video_file=None, deadline=None):
+        synthesized.append(user_input)
+        return '{"dominant_motivation": "mastery"}'
+
+    monkeypatch.setattr(p, "_generate_content", generate)
+    return synthesized
+
+
+def test_market_analysis_skips_creatives_once_analysis_deadline_passes(monkeypatch, market_csv):
+    analyzed = []
+
+    def analyze(url, deadline=None):
+        analyzed.append(url)
+        time.sleep(0.6)
+        return {"hook": "ok"}
+
+    # 1 s overall with 0.5 s held back for synthesis: only the first creative fits
+    p = CreativeAnalyticsPipeline("test-key", synthesis_reserve=0.5)
+    synthesized = stub_market(monkeypatch, p, analyze)
+    assert p.get_winning_dna(market_csv, deadline=Deadline(1)) == {"dominant_motivation": "mastery"}
+
+    assert analyzed == ["http://a"]
+    assert synthesized
+    assert [(c["rank"], c["app"], c["status"]) for c in p.creative_statuses] == [
+        (1, "App A", "success"),
+        (2, "App B", pipeline.DEADLINE_EXCEEDED),
+        (3, "App C", pipeline.DEADLINE_EXCEEDED),
+    ]
+    assert p.creative_statuses[0]["error"] is None
+    assert p.creative_statuses[1]["error"] == "Deadline exceeded before analysis started"
+
+
+@pytest.mark.parametrize("overall", [None, 10])
+def test_each_creative_is_capped_by_creative_deadline(monkeypatch, market_csv, overall):
+    budgets = []
+
+    def analyze(url, deadline=None):
+        budgets.append(deadline.remaining())
+        return {"hook": "ok"}
+
+    p = CreativeAnalyticsPipeline("test-key", creative_deadline=0.5)
+    stub_market(monkeypatch, p, analyze)
+    p.get_winning_dna(market_csv, deadline=Deadline(overall))
+    assert len(budgets) == 3
+    assert all(0.4 < budget <= 0.5 for budget in budgets)
+
+
+def test_market_analysis_with_no_successful_creative_is_not_synthesized(monkeypatch, market_csv):
+    def analyze(url, deadline=None):
+        if url == "http://a":
+            return {"error": "Failed to download video from URL"}
+        return {"error": "Deadline exceeded during download", "status": pipeline.DEADLINE_EXCEEDED}
+
+    p = CreativeAnalyticsPipeline("test-key")
+    synthesized = stub_market(monkeypatch, p, analyze)
+    with pytest.raises(DeadlineExceeded):
+        p.get_winning_dna(market_csv, deadline=Deadline(10))
+    assert synthesized == []
+    assert [c["status"] for c in p.creative_statuses] == ["error", pipeline.DEADLINE_EXCEEDED, pipeline.DEADLINE_EXCEEDED]
+
+
+def test_market_analysis_with_only_errors_raises_plain_error(monkeypatch, market_csv):
+    p = CreativeAnalyticsPipeline("test-key")
+    synthesized = stub_market(monkeypatch, p, lambda url, deadline=None: {"error": "Video processing failed"})
+    with pytest.raises(Exception, match="None of the top creatives") as excinfo:
+        p.get_winning_dna(market_csv, deadline=Deadline(10))
+    assert not isinstance(excinfo.value, DeadlineExceeded)
+    assert synthesized == []